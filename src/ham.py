@@ -1,8 +1,91 @@
 """Rydberg Hamiltonian"""
+import functools
+import os
+
+import numpy as np
 import qutip
 
 from .qdyn.io import read_indexed_matrix
 
+
+def _read_hamiltonian_matrix(filename, n_hilbert):
+    """Read the matrix of dimension `n_hilbert` from the given `filename`
+
+    The result is cached for the absolute path of `filename` and the file's
+    modification time, so that a relative `filename` after a change of the
+    working directory, or a file that was rewritten, is read again. Only the
+    32 most recently used matrices are kept. The arrays of the returned
+    matrix are marked as read-only, so that the cached matrix cannot be
+    modified accidentally.
+    """
+    filename = os.path.abspath(filename)
+    mtime = os.stat(filename).st_mtime_ns
+    return _read_hamiltonian_matrix_cached(filename, n_hilbert, mtime)
+
+
+@functools.lru_cache(maxsize=32)
+def _read_hamiltonian_matrix_cached(filename, n_hilbert, mtime):
+    """Implementation of :func:`_read_hamiltonian_matrix`
+
+    The `mtime` argument is not used, except as part of the cache key.
+    """
+    m = read_indexed_matrix(
+        filename,
+        format='csr',
+        shape=(n_hilbert, n_hilbert),
+        expand_hermitian=False,
+    )
+    for array in (m.data, m.indices, m.indptr):
+        array.flags.writeable = False
+    return m
+
+
+def _drift_hamiltonian(H_drift, H_pi, F_DC):
+    """Return ``H_drift + F_DC * H_pi``
+
+    The underlying sparse matrices are combined directly, to avoid the
+    overhead of Qobj arithmetic. As with Qobj arithmetic, entries below
+    ``qutip.settings.auto_tidyup_atol`` are removed from the result (if
+    ``qutip.settings.auto_tidyup`` is set), so that near-cancelling entries
+    are not stored explicitly.
+
+    Example:
+
+        >>> H_drift = qutip.Qobj(np.diag([1.0, 1e-20, 2.0]))
+        >>> H_pi = qutip.Qobj(np.array([
+        ...     [0.0, 1e-15, 0.0], [1e-15, 0.0, 1.0], [0.0, 1.0, 0.0]]))
+        >>> H_0 = _drift_hamiltonian(H_drift, H_pi, 0.1)
+        >>> H_0.data.nnz == (H_drift + 0.1 * H_pi).data.nnz
+        True
+        >>> H_0 == H_drift + 0.1 * H_pi
+        True
+
+        This includes matrices with the same sparsity pattern, where the
+        entries may cancel:
+
+        >>> H_drift = qutip.Qobj(np.array([[1.0, 0.1], [0.1, 2.0]]))
+        >>> H_pi = qutip.Qobj(np.array([[1.0, -0.3], [-0.3, 1.0]]))
+        >>> H_0 = _drift_hamiltonian(H_drift, H_pi, 1 / 3)
+        >>> H_0.data.nnz == (H_drift + H_pi / 3).data.nnz == 2
+        True
+    """
+    drift, pi = H_drift.data, H_pi.data
+    if np.array_equal(drift.indptr, pi.indptr) and np.array_equal(
+        drift.indices, pi.indices
+    ):
+        # same sparsity pattern: AXPY on the stored values only. This keeps
+        # every cancelling entry as an explicit value, so it relies on the
+        # tidyup below
+        H_0_data = drift.copy()
+        H_0_data.data += F_DC * pi.data
+    else:
+        H_0_data = drift + F_DC * pi
+    H_0 = qutip.Qobj(H_0_data, dims=H_drift.dims)
+    if qutip.settings.auto_tidyup:
+        H_0.tidyup()
+    return H_0
+
+
 def rydberg_hamiltonian(
     n_hilbert,
     H_drift_file,
@@ -20,23 +103,14 @@ def rydberg_hamiltonian(
         F_DC (float)
         Omega_sig (Pulse)
         exapnd_H_sigma (bool)
+
+    The matrices are read from file only on the first call for any of the
+    given files (or after a file has been modified); only `F_DC` and
+    `Omega_sigma` are expected to change between calls.
     """
-    H_drift = qutip.Qobj(
-        read_indexed_matrix(
-            H_drift_file, shape=(n_hilbert, n_hilbert), expand_hermitian=False
-        )
-    )
-    H_sigma = qutip.Qobj(
-        read_indexed_matrix(
-            H_sigma_file,
-            shape=(n_hilbert, n_hilbert),
-            expand_hermitian=False,
-        )
-    )
-    H_pi = qutip.Qobj(
-        read_indexed_matrix(
-            H_pi_file, shape=(n_hilbert, n_hilbert), expand_hermitian=False
-        )
-    )
-    H_0 = H_drift + F_DC * H_pi
-    return [H_0, [H_sigma, Omega_sigma], [H_sigma.dag(), Omega_sigma]]
+    H_drift = qutip.Qobj(_read_hamiltonian_matrix(H_drift_file, n_hilbert))
+    H_sigma = qutip.Qobj(_read_hamiltonian_matrix(H_sigma_file, n_hilbert))
+    H_pi = qutip.Qobj(_read_hamiltonian_matrix(H_pi_file, n_hilbert))
+    H_0 = _drift_hamiltonian(H_drift, H_pi, F_DC)
+    H_sigma_dag = H_sigma.dag()
+    return [H_0, [H_sigma, Omega_sigma], [H_sigma_dag, Omega_sigma]]
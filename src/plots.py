@@ -13,12 +13,23 @@ def show_spy(
     ylim=None,
     label_pixels=False,
     markersize=1,
+    ax=None,
 ):
-    """Show the sparsity pattern of the given sparse matrix"""
-    if figsize is None:
-        fig, ax = plt.subplots()
+    """Show the sparsity pattern of the given sparse matrix
+
+    If `ax` is given, it is cleared and the sparsity pattern is drawn onto it,
+    instead of creating a new figure. This allows to re-use a figure when
+    calling `show_spy` repeatedly.
+    """
+    new_figure = ax is None
+    if new_figure:
+        if figsize is None:
+            fig, ax = plt.subplots()
+        else:
+            fig, ax = plt.subplots(figsize=figsize)
     else:
-        fig, ax = plt.subplots(figsize=figsize)
+        fig = ax.figure
+        ax.cla()
     ax.spy(m, markersize=markersize)
     diag_vals = np.linspace(0, m.shape[0], 10)
     if show_diagonal:
@@ -36,7 +47,8 @@ def show_spy(
         fig.show()
     else:
         fig.savefig(outfile)
-        plt.close()
+        if new_figure:
+            plt.close(fig)
 
 
 def plot_population(pop_data, pop_data_baseline=None, alpha=1.0):
@@ -1,22 +1,134 @@
 """Module containing the :class:`Pulse` class and functions for initializing
 pulse shapes."""
 import logging
+import math
 import re
 from collections.abc import MutableMapping
 
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy.fftpack
-from matplotlib.gridspec import GridSpec
-from numpy.fft import fft, fftfreq
-from scipy import signal
-from scipy.interpolate import UnivariateSpline
+from scipy.fft import fft, fftfreq, fftshift, ifft, irfft, rfft
 
 from .io import open_file, writetotxt
 from .linalg import iscomplexobj
+from .memoize import memoize
 from .units import UnitConvert, UnitFloat
 
 
+# patterns for the header line of a pulse file, see `Pulse.read`
+_HEADER_RX = {
+    'complex': re.compile(
+        r'''
+        ^\#\s*t(ime)? \s* \[\s*(?P<time_unit>\w+)\s*\]\s*
+        Re\((ampl|E)\) \s* \[\s*(?P<ampl_unit>\w+)\s*\]\s*
+        Im\((ampl|E)\) \s* \[(\w+)\]\s*$''',
+        re.X | re.I,
+    ),
+    'real': re.compile(
+        r'''
+        ^\#\s*t(ime)? \s* \[\s*(?P<time_unit>\w+)\s*\]\s*
+        Re\((ampl|E)\) \s* \[\s*(?P<ampl_unit>\w+)\s*\]\s*$''',
+        re.X | re.I,
+    ),
+    'abs': re.compile(
+        r'''
+        ^\#\s*t(ime)? \s* \[\s*(?P<time_unit>\w+)\s*\]\s*
+        (Abs\()?(ampl|E)(\))? \s* \[\s*(?P<ampl_unit>\w+)\s*\]\s*$''',
+        re.X | re.I,
+    ),
+}
+
+_FREE_HEADER_RX = re.compile(
+    r'''
+    ^\# .* \[\s*(?P<time_unit>\w+)\s*\]
+    .* \[\s*(?P<ampl_unit>\w+)\s*\]''',
+    re.X,
+)
+
+_OCT_ITER_RX = re.compile(r'OCT iter[\s:]*(\d+)', re.I)
+
+# maximum number of elements in the (n_freq x n_t) intermediate arrays of
+# `carrier` and `CRAB_carrier`, which are evaluated in chunks of frequencies
+_OUTER_CHUNK_SIZE = 2 ** 17
+
+
+def _evaluate_filter_func(filter_func, freqs):
+    """Evaluate `filter_func` for all values in the `freqs` array
+
+    If `filter_func` works on numpy arrays, it is called only once, for the
+    entire array. Otherwise, it is called for each value in `freqs`.
+    """
+    try:
+        filter = np.asarray(filter_func(freqs), dtype=np.float64)
+        if filter.shape == freqs.shape:
+            return filter
+    except (TypeError, ValueError):
+        pass
+    return np.fromiter(
+        (filter_func(f) for f in freqs), dtype=np.float64, count=len(freqs)
+    )
+
+
+def _check_filter_range(filter):
+    """Raise a ValueError if any value in `filter` is outside of [0, 1]"""
+    # min <= max, so checking the two bounds is enough. A NaN in `filter`
+    # propagates into both reductions and fails the check
+    if not (np.min(filter) >= 0 and np.max(filter) <= 1):
+        raise ValueError("filter values must be in the range [0, 1]")
+
+
+def _unshift_kernel(amplitude):
+    """Amplitudes on the unshifted time grid, see `Pulse._unshift`"""
+    pulse_new = np.empty(len(amplitude) + 1, dtype=amplitude.dtype.type)
+    pulse_new[0] = amplitude[0]
+    pulse_new[1:-1] = 0.5 * (amplitude[:-1] + amplitude[1:])
+    pulse_new[-1] = amplitude[-1]
+    return pulse_new
+
+
+def _shift_kernel(data_old):
+    """Inverse of `_unshift_kernel`, see `Pulse._shift`"""
+    # The recurrence new[i] = 2 * old[i] - new[i-1] with new[0] = old[0] has
+    # the closed form new[i] = (-1)^i * (old[0] + 2 * sum_k (-1)^k old[k]),
+    # summing over k = 1..i, which is a cumulative sum instead of a loop
+    n = len(data_old) - 1
+    data_new = np.empty(n, dtype=data_old.dtype.type)
+    signs = np.ones(len(data_old))
+    signs[1::2] = -1.0
+    partial_sums = np.cumsum(signs[1 : n - 1] * data_old[1 : n - 1])
+    data_new[0] = data_old[0]
+    data_new[1 : n - 1] = signs[1 : n - 1] * (
+        data_old[0] + 2.0 * partial_sums
+    )
+    data_new[-1] = data_old[-1]
+    return data_new
+
+
+def _split_postamble(text):
+    """Split the trailing comment lines from the given content of a pulse
+    file (following the preamble).
+
+    Only the end of `text` is scanned. Returns the data part of `text` and
+    the list of stripped comment lines that make up the postamble, or None
+    instead of the data if there are further comment lines inside the data,
+    in which case `text` must be processed line by line.
+    """
+    postamble = []
+    end = len(text)
+    while end > 0:
+        start = text.rfind('\n', 0, end - 1) + 1
+        line = text[start:end]
+        if line.startswith('#'):
+            postamble.append(line.strip())
+        elif line.strip() != '':
+            break
+        end = start
+    postamble.reverse()
+    data = text[:end]
+    if '\n#' in data:
+        return None, postamble
+    return data, postamble
+
+
 class _PulseConfigAttribs(MutableMapping):
     """Custom ordered dict of config file attributes of pulses.
 
@@ -29,8 +141,10 @@ class _PulseConfigAttribs(MutableMapping):
         parent (Pulse): The pulse to which the settings apply
     """
 
-    _synchronized_keys = ['time_unit', 'ampl_unit']
-    _read_only_keys = ['type', 'is_complex']
+    _synchronized_keys = frozenset(['time_unit', 'ampl_unit'])
+    _read_only_keys = frozenset(['type', 'is_complex'])
+    # keys whose value is the attribute of the same name of the parent pulse
+    _linked_keys = _synchronized_keys | frozenset(['is_complex'])
     _required_keys = [
         'id',
         'type',
@@ -63,9 +177,7 @@ class _PulseConfigAttribs(MutableMapping):
             self._data[key] = value
 
     def __getitem__(self, key):
-        if key == 'is_complex':
-            return self._parent.is_complex
-        elif key in self._synchronized_keys:
+        if key in self._linked_keys:
             return getattr(self._parent, key)
         else:
             return self._data[key]
@@ -114,6 +226,10 @@ class Pulse:
             given, an appropriate unit based on `time_unit` will be chosen, if
             possible (or a `TypeError` will be raised.
 
+    If `tgrid` and `amplitude` are already contiguous numpy arrays of double
+    precision, they are used directly, without being copied. Pass copies if
+    the arrays are also used elsewhere.
+
     Attributes:
         tgrid (numpy.ndarray(float)): time points at which the pulse values
             are defined, from ``t0 + dt/2`` to ``T - dt/2``.
@@ -201,13 +317,13 @@ class Pulse:
         freq_unit=None,
         config_attribs=None,
     ):
-        tgrid = np.array(tgrid, dtype=np.float64)
+        tgrid = np.ascontiguousarray(tgrid, dtype=np.float64)
         if amplitude is None:
             amplitude = np.zeros(len(tgrid))
         if iscomplexobj(amplitude):
-            amplitude = np.array(amplitude, dtype=np.complex128)
+            amplitude = np.ascontiguousarray(amplitude, dtype=np.complex128)
         else:
-            amplitude = np.array(amplitude, dtype=np.float64)
+            amplitude = np.ascontiguousarray(amplitude, dtype=np.float64)
         self.tgrid = tgrid
         self.amplitude = amplitude
         if time_unit is None:
@@ -221,6 +337,7 @@ class Pulse:
 
         self.preamble = []
         self.postamble = []
+        self._unit_factors = {}
 
         self.freq_unit = freq_unit
         if freq_unit is None:
@@ -250,20 +367,23 @@ class Pulse:
         for attr in public_attribs:
             if getattr(self, attr) != getattr(other, attr):
                 return False
-        try:
-            if np.max(np.abs(self.tgrid - other.tgrid)) > 1.0e-12:
-                return False
-            if np.max(np.abs(self.amplitude - other.amplitude)) > 1.0e-12:
-                return False
-        except ValueError:
+        if self.tgrid.shape != other.tgrid.shape:
+            return False
+        if self.amplitude.shape != other.amplitude.shape:
+            return False
+        if not np.allclose(self.tgrid, other.tgrid, rtol=0.0, atol=1.0e-12):
+            return False
+        if not np.allclose(
+            self.amplitude, other.amplitude, rtol=0.0, atol=1.0e-12
+        ):
             return False
         return True
 
     def copy(self):
         """Return a copy of the pulse"""
         return self.__class__(
-            self.tgrid,
-            self.amplitude,
+            self.tgrid.copy(),
+            self.amplitude.copy(),
             time_unit=self.time_unit,
             ampl_unit=self.ampl_unit,
             freq_unit=self.freq_unit,
@@ -301,6 +421,20 @@ class Pulse:
             "Unknown freq_unit %s" % self.freq_unit
         )
 
+    def _unit_factor(self, from_unit, to_unit):
+        """Factor for converting values from `from_unit` to `to_unit`
+
+        The factors are cached on the instance, so that repeated calls of
+        properties like :attr:`w_max` or :meth:`fftfreq` do not have to go
+        through :attr:`unit_convert` every time.
+        """
+        try:
+            return self._unit_factors[(from_unit, to_unit)]
+        except KeyError:
+            factor = float(self.unit_convert.convert(1.0, from_unit, to_unit))
+            self._unit_factors[(from_unit, to_unit)] = factor
+            return factor
+
     @classmethod
     def read(
         cls,
@@ -341,46 +475,42 @@ class Pulse:
             file.
         """
         logger = logging.getLogger(__name__)
-        header_rx = {
-            'complex': re.compile(
-                r'''
-                ^\#\s*t(ime)? \s* \[\s*(?P<time_unit>\w+)\s*\]\s*
-                Re\((ampl|E)\) \s* \[\s*(?P<ampl_unit>\w+)\s*\]\s*
-                Im\((ampl|E)\) \s* \[(\w+)\]\s*$''',
-                re.X | re.I,
-            ),
-            'real': re.compile(
-                r'''
-                ^\#\s*t(ime)? \s* \[\s*(?P<time_unit>\w+)\s*\]\s*
-                Re\((ampl|E)\) \s* \[\s*(?P<ampl_unit>\w+)\s*\]\s*$''',
-                re.X | re.I,
-            ),
-            'abs': re.compile(
-                r'''
-                ^\#\s*t(ime)? \s* \[\s*(?P<time_unit>\w+)\s*\]\s*
-                (Abs\()?(ampl|E)(\))? \s* \[\s*(?P<ampl_unit>\w+)\s*\]\s*$''',
-                re.X | re.I,
-            ),
-        }
-
-        try:
-            t, x, y = np.genfromtxt(filename, unpack=True, dtype=np.float64)
-        except ValueError:
-            t, x = np.genfromtxt(filename, unpack=True, dtype=np.float64)
-            y = None
         preamble = []
-        postamble = []
         with open_file(filename) as in_fh:
-            in_preamble = True
-            for line in in_fh:
-                if line.startswith('#'):
-                    if in_preamble:
-                        preamble.append(line.strip())
-                    else:
+            # the preamble is read line by line, the remaining data (and
+            # postamble) in one go
+            line = in_fh.readline()
+            while line.startswith('#'):
+                preamble.append(line.strip())
+                line = in_fh.readline()
+            text = line + in_fh.read()
+            data_text, postamble = _split_postamble(text)
+            if data_text is None:
+                # comments interspersed with the data also go into the
+                # postamble
+                postamble = []
+                data_lines = []
+                for line in text.splitlines():
+                    if line.startswith('#'):
                         postamble.append(line.strip())
-                else:
-                    if in_preamble:
-                        in_preamble = False
+                    else:
+                        data_lines.append(line)
+            else:
+                data_lines = data_text.splitlines()
+            # one contiguous row per column
+            data = np.ascontiguousarray(
+                np.loadtxt(data_lines, dtype=np.float64, ndmin=2).T
+            )
+            if len(data) == 3:
+                t, x, y = data
+            elif len(data) == 2:
+                t, x = data
+                y = None
+            else:
+                raise ValueError(
+                    "Pulse file must contain two or three columns, not %d"
+                    % len(data)
+                )
             # the last line of the preamble *must* be the header line. We will
             # process it and remove it from preamble
             mode = None
@@ -395,7 +525,7 @@ class Pulse:
                     header_line = preamble.pop()
                 except IndexError:
                     raise IOError("Pulse file does not contain a preamble")
-                for file_mode, pattern in header_rx.items():
+                for file_mode, pattern in _HEADER_RX.items():
                     match = pattern.match(header_line)
                     if match:
                         mode = file_mode
@@ -411,13 +541,7 @@ class Pulse:
                         mode = 'real'
                     else:
                         mode = 'complex'
-                    free_pattern = re.compile(
-                        r'''
-                    ^\# .* \[\s*(?P<time_unit>\w+)\s*\]
-                        .* \[\s*(?P<ampl_unit>\w+)\s*\]''',
-                        re.X,
-                    )
-                    match = free_pattern.search(header_line)
+                    match = _FREE_HEADER_RX.search(header_line)
                     if match:
                         file_time_unit = match.group('time_unit')
                         file_ampl_unit = match.group('ampl_unit')
@@ -431,7 +555,9 @@ class Pulse:
         elif mode == 'real':
             amplitude = x
         elif mode == 'complex':
-            amplitude = x + 1j * y
+            amplitude = np.empty(x.shape, dtype=np.complex128)
+            amplitude.real = x
+            amplitude.imag = y
         else:
             raise ValueError("mode must be 'abs', 'real', or 'complex'")
 
@@ -467,12 +593,22 @@ class Pulse:
         ampl_unit=None,
         freq_unit=None,
         config_attribs=None,
+        vectorized=False,
     ):
         """Instantiate a pulse from an amplitude function `func`.
 
+        If `vectorized` is True, `func` is called only once, with the entire
+        `tgrid` as a numpy array, and must return an array of amplitudes of
+        the same size. This is the case for any function composed of numpy
+        ufuncs, e.g. :func:`blackman`. Otherwise, `func` is called separately
+        for each point in `tgrid`.
+
         All other parameters are passed on to `__init__`
         """
-        amplitude = [func(t) for t in tgrid]
+        if vectorized:
+            amplitude = np.asarray(func(np.asarray(tgrid, dtype=np.float64)))
+        else:
+            amplitude = [func(t) for t in tgrid]
         return cls(
             tgrid,
             amplitude=amplitude,
@@ -513,14 +649,14 @@ class Pulse:
         current sampling rate.
         """
         n = len(self.tgrid)
-        dt = float(self.unit_convert.convert(self.dt, self.time_unit, 'iu'))
+        dt = float(self.dt) * self._unit_factor(self.time_unit, 'iu')
         if n % 2 == 1:
             # odd
             w_max = ((n - 1) * np.pi) / (n * dt)
         else:
             # even
             w_max = np.pi / dt
-        return self.unit_convert.convert(w_max, 'iu', self.freq_unit)
+        return w_max * self._unit_factor('iu', self.freq_unit)
 
     @property
     def dw(self):
@@ -566,25 +702,45 @@ class Pulse:
         If `allow_args` is True, the resulting function takes a second argument
         `args` that is ignored. This is for compatibility with qutip, see
         http://qutip.org/docs/latest/guide/dynamics/dynamics-time.html.
+
+        The resulting function works on a copy of the pulse values (as a list
+        of Python numbers), taken when calling `as_func`. Thus, the function
+        will not reflect any later changes to :attr:`amplitude`, and
+        `as_func` should be called again after modifying the pulse:
+
+        >>> tgrid = pulse_tgrid(10, 100)
+        >>> pulse = Pulse(
+        ...     tgrid, np.ones(len(tgrid)), time_unit='ns', ampl_unit='MHz'
+        ... )
+        >>> func = pulse.as_func()
+        >>> pulse.amplitude *= 2
+        >>> func(5.0), pulse.as_func()(5.0)
+        (1.0, 2.0)
         """
 
         t0 = float(self.t0)
         T = float(self.T)
         dt = float(self.dt)
         offset = t0 + 0.5 * dt
+        # The function is evaluated many times by ODE solvers: indexing a list
+        # of Python numbers, and doing the arithmetic with them, is
+        # significantly faster than working with numpy scalars
+        amplitude = self.amplitude.tolist()
+        inv_dt = 1.0 / dt
+        n_last = len(amplitude) - 1
 
         def func_linear(t):
             """linear interpolation of pulse amplitude"""
-            if t0 <= float(t) <= T:
-                t = float(t) - offset
-                n = max(int(t / dt), 0)
-                delta = max(t - n * dt, 0.0) / dt
-                try:
-                    return (1 - delta) * self.amplitude[
-                        n
-                    ] + delta * self.amplitude[n + 1]
-                except IndexError:  # last n
-                    return self.amplitude[n]
+            t = float(t)
+            if t0 <= t <= T:
+                t -= offset
+                n = int(t * inv_dt)  # int() rounds towards zero, so n >= 0
+                if n >= n_last:
+                    return amplitude[n_last]
+                delta = (t - n * dt) * inv_dt
+                if delta <= 0.0:  # before the first point
+                    return amplitude[n]
+                return (1 - delta) * amplitude[n] + delta * amplitude[n + 1]
             else:
                 raise ValueError(
                     "Value t=%g not in range [%g, %g]" % (t, t0, T)
@@ -592,17 +748,15 @@ class Pulse:
 
         def func_piecewise(t):
             """piecewise interpolation of pulse amplitude"""
-            if t0 <= float(t) <= T:
-                t = float(t) - offset
-                n = max(int(t / dt), 0)
-                delta = max(t - n * dt, 0.0) / dt
-                if delta < 0.5:
-                    return self.amplitude[n]
-                else:
-                    try:
-                        return self.amplitude[n + 1]
-                    except IndexError:  # last n
-                        return self.amplitude[n]
+            t = float(t)
+            if t0 <= t <= T:
+                t -= offset
+                n = int(t * inv_dt)  # int() rounds towards zero, so n >= 0
+                if n >= n_last:
+                    return amplitude[n_last]
+                if (t - n * dt) * inv_dt < 0.5:
+                    return amplitude[n]
+                return amplitude[n + 1]
             else:
                 raise ValueError(
                     "Value t=%g not in range [%g, %g]" % (t, t0, T)
@@ -626,35 +780,102 @@ class Pulse:
                 % (str(list(func_map.keys())), interpolation)
             )
 
+    def sample(self, t, interpolation='linear'):
+        """Evaluate the pulse for an array of time values.
+
+        This is the vectorized equivalent of calling the function returned by
+        :meth:`as_func` for each value in `t`, and much faster when the pulse
+        has to be evaluated at many points at once.
+
+        Args:
+            t (numpy.ndarray): Time values in the range [:attr:`t0`,
+                :attr:`T`], in units of :attr:`time_unit`
+            interpolation (str): Either 'linear' or 'piecewise', see
+                :meth:`as_func`
+
+        Returns:
+            numpy.ndarray: The (interpolated) pulse amplitudes, in units of
+            :attr:`ampl_unit`, with the same shape as `t`
+
+        Raises:
+            ValueError: If any value in `t` is outside the range of the pulse,
+                or for an invalid `interpolation`
+        """
+        if interpolation not in ['linear', 'piecewise']:
+            raise ValueError(
+                "Invalid interpolation not in %s: %s"
+                % (str(['linear', 'piecewise']), interpolation)
+            )
+        t0 = float(self.t0)
+        T = float(self.T)
+        dt = float(self.dt)
+        offset = t0 + 0.5 * dt
+        inv_dt = 1.0 / dt
+        n_last = len(self.amplitude) - 1
+        t = np.asarray(t, dtype=np.float64)
+        outside = (t < t0) | (t > T)
+        if np.any(outside):
+            raise ValueError(
+                "Value t=%g not in range [%g, %g]" % (t[outside][0], t0, T)
+            )
+        t = t - offset
+        # truncation towards zero, as in as_func: n >= 0
+        n = np.minimum((t * inv_dt).astype(np.intp), n_last)
+        delta = (t - n * dt) * inv_dt
+        n_next = np.minimum(n + 1, n_last)
+        if interpolation == 'linear':
+            delta = np.where((delta <= 0.0) | (n == n_last), 0.0, delta)
+            return (1 - delta) * self.amplitude[n] + delta * self.amplitude[
+                n_next
+            ]
+        else:  # piecewise
+            return self.amplitude[np.where(delta < 0.5, n, n_next)]
+
     def convert(self, time_unit=None, ampl_unit=None, freq_unit=None):
-        """Convert the pulse data to different units"""
+        """Convert the pulse data to different units
+
+        The converted :attr:`tgrid` and :attr:`amplitude` are new arrays, so
+        arrays shared with other pulses (or with the caller) are not modified:
+
+        >>> tgrid = pulse_tgrid(10, 100)
+        >>> p1 = Pulse(tgrid, time_unit='ns', ampl_unit='MHz')
+        >>> p2 = Pulse(tgrid, time_unit='ns', ampl_unit='MHz')
+        >>> p1.convert(time_unit='fs')
+        >>> print(p1.T, p2.T)
+        1e+07_fs 10_ns
+        >>> print("%.5f" % tgrid[-1])
+        9.94949
+        """
+        # rebinding (instead of scaling in place) matters because __init__
+        # does not copy the arrays it is given
         if time_unit is not None:
             factor = self.unit_convert.convert(1.0, self.time_unit, time_unit)
-            self.tgrid *= factor
+            self.tgrid = self.tgrid * factor
             self.time_unit = time_unit
         if ampl_unit is not None:
             factor = self.unit_convert.convert(1.0, self.ampl_unit, ampl_unit)
-            self.amplitude *= factor
+            self.amplitude = self.amplitude * factor
             self.ampl_unit = ampl_unit
         if freq_unit is not None:
             self.freq_unit = freq_unit
+        self._unit_factors.clear()
         self._check()
 
     def get_timegrid_point(self, t, move="left"):
         """Return the next point to the left (or right) of the given `t` which
         is on the pulse time grid
         """
-        t_start = self.tgrid[0]
-        t_stop = self.tgrid[-1]
-        dt = self.dt
+        t_start = float(self.tgrid[0])
+        t_stop = float(self.tgrid[-1])
+        dt = float(self.tgrid[1] - self.tgrid[0])
         if t < t_start:
             return t_start
         if t > t_stop:
             return t_stop
         if move == "left":
-            n = np.floor((t - t_start) / dt)
+            n = math.floor((t - t_start) / dt)
         else:
-            n = np.ceil((t - t_start) / dt)
+            n = math.ceil((t - t_start) / dt)
         return t_start + n * dt
 
     @property
@@ -663,15 +884,18 @@ class Pulse:
 
         .. math:: \\int_{-\\infty}^{\\infty} \\vert|E(t)\\vert^2 dt
         """
-        return np.sum(self.amplitude ** 2) * float(self.dt)
+        if self.is_complex:
+            e = np.vdot(self.amplitude, self.amplitude).real
+        else:
+            e = np.dot(self.amplitude, self.amplitude)
+        return float(e) * float(self.dt)
 
     @property
     def oct_iter(self):
         """OCT iteration number from the pulse preamble, if available. If not
         available, 0"""
-        iter_rx = re.compile(r'OCT iter[\s:]*(\d+)', re.I)
         for line in self.preamble:
-            iter_match = iter_rx.search(line)
+            iter_match = _OCT_ITER_RX.search(line)
             if iter_match:
                 return int(iter_match.group(1))
         return 0
@@ -701,6 +925,10 @@ class Pulse:
             Real (`mode in ['abs', 'real', 'imag']`) or complex
             (`mode='complex'`) amplitude of each frequency component.
 
+        Raises:
+
+            ValueError: if `mode` is not one of the possible values
+
         Notes:
 
             If `sort=False` and `mode='complex'`, the original pulse
@@ -710,23 +938,27 @@ class Pulse:
             doing the normalization on the backward transform). You might want
             to normalized by 1/n for plotting.
         """
-        s = fft(self.amplitude)  # spectrum amplitude
+        if mode not in ['complex', 'abs', 'real', 'imag']:
+            raise ValueError("Invalid mode: %s" % mode)
+        s = fft(self.amplitude, workers=-1)  # spectrum amplitude
         f = self.fftfreq(freq_unit=freq_unit)
-        modifier = {
-            'abs': lambda s: np.abs(s),
-            'real': lambda s: np.real(s),
-            'imag': lambda s: np.imag(s),
-            'complex': lambda s: s,
-        }
+        # apply the mode before sorting, so that only the (real) result has
+        # to be shifted
+        if mode == 'abs':
+            s = np.abs(s)
+        elif mode == 'real':
+            s = s.real
+        elif mode == 'imag':
+            s = s.imag
         if sort:
-            order = np.argsort(f)
-            f = f[order]
-            s = s[order]
-        return f, modifier[mode](s)
+            # the output of fftfreq is sorted by a cyclic shift
+            f = fftshift(f)
+            s = fftshift(s)
+        return f, s
 
     def fftfreq(self, freq_unit=None):
         """Return the FFT frequencies associated with the pulse. Cf.
-        `numpy.fft.fftfreq`
+        `scipy.fft.fftfreq`
 
         Parameters:
             freq_unit (str): Desired unit of the output array.
@@ -741,10 +973,10 @@ class Pulse:
         if freq_unit is None:
             freq_unit = self.freq_unit
         n = len(self.amplitude)
-        dt = float(self.unit_convert.convert(self.dt, self.time_unit, 'iu'))
-        return self.unit_convert.convert(
-            fftfreq(n, d=dt / (2.0 * np.pi)), 'iu', freq_unit
-        )
+        dt = float(self.dt) * self._unit_factor(self.time_unit, 'iu')
+        freqs = fftfreq(n, d=dt / (2.0 * np.pi))
+        freqs *= self._unit_factor('iu', freq_unit)
+        return freqs
 
     def derivative(self):
         """Calculate the derivative of the current pulse and return it as a new
@@ -753,9 +985,22 @@ class Pulse:
         """
         self._unshift()
         T = self.tgrid[-1] - self.tgrid[0]
-        deriv = scipy.fftpack.diff(self.amplitude) * (2.0 * np.pi / T)
+        n = len(self.amplitude)
+        # spectral derivative, with the same conventions as
+        # scipy.fftpack.diff (the Nyquist component is dropped for even n)
+        if self.is_complex:
+            k = 1j * fftfreq(n, d=1.0 / n)
+            if n % 2 == 0:
+                k[n // 2] = 0.0
+            deriv = ifft(fft(self.amplitude, workers=-1) * k, workers=-1)
+        else:
+            k = 1j * np.arange(n // 2 + 1)
+            if n % 2 == 0:
+                k[-1] = 0.0
+            deriv = irfft(rfft(self.amplitude, workers=-1) * k, n, workers=-1)
+        deriv *= 2.0 * np.pi / T
         deriv_pulse = Pulse(
-            tgrid=self.tgrid,
+            tgrid=self.tgrid.copy(),
             amplitude=deriv,
             time_unit=self.time_unit,
             ampl_unit='unitless',
@@ -764,47 +1009,118 @@ class Pulse:
         deriv_pulse._shift()
         return deriv_pulse
 
-    def phase(self, unwrap=False, s=None, derivative=False, freq_unit=None):
+    def phase(
+        self,
+        unwrap=False,
+        s=None,
+        derivative=False,
+        freq_unit=None,
+        method='spline',
+    ):
         """Return the pulse's complex phase, or derivative of the phase
 
         Parameters:
             unwrap (bool): If False, report the phase in ``[-pi:pi]``. If True,
                 the phase may take any real value, avoiding the discontinuous
                 jumps introduced by limiting the phase to a 2 pi interval.
-            s (float or None): smoothing parameter, see
-                :py:class:`scipy.interpolate.UnivariateSpline`. If None, no
-                smoothing is performed.
+            s (float or None): smoothing parameter. For ``method='spline'``,
+                see :py:class:`scipy.interpolate.UnivariateSpline`. For
+                ``method='savgol'``, the window length (number of grid
+                points, rounded up to an odd number, and at least 5 if
+                `derivative` is True), see :func:`scipy.signal.savgol_filter`.
+                If None, no smoothing is performed.
             derivative (bool): If False, return the (smoothed) phase directly.
                 If True, return the derivative of the (smoothed) phase.
             freq_unit (str or None): If `derivative` is True, the unit in which
                 the derivative should be calculated. If None, `self.freq_unit`
                 is used.
+            method (str): Smoothing method, either 'spline' (univariate
+                splines) or 'savgol' (Savitzky-Golay filter of third order).
+                The Savitzky-Golay filter is a simple convolution and is much
+                faster than the spline fit for long pulses.
 
         Note:
             When calculating the derivative, some smoothing is generally
             required. By specifying a smoothing parameter `s`, the phase is
-            smoothed through univeriate splines before calculating the
-            derivative.
+            smoothed through univeriate splines (or a Savitzky-Golay filter)
+            before calculating the derivative. If `s` is not given, it
+            defaults to 1 for ``method='spline'`` and to 11 for
+            ``method='savgol'``.
 
             When calculating the phase directly (instead of the derivative),
             smoothing should only be used when also unwrapping the phase.
+
+        Raises:
+
+            ValueError: if `method` is not one of the possible values, or if
+                the pulse has fewer than three points for calculating the
+                derivative with ``method='savgol'``
+
+        Example:
+
+            Even for a very small window, the Savitzky-Golay filter yields
+            the derivative of the phase (the frequency of a pulse
+            ``exp(i w t)``):
+
+            >>> tgrid = pulse_tgrid(10, 100)
+            >>> pulse = Pulse(
+            ...     tgrid, np.exp(2.0j * tgrid), time_unit='iu', ampl_unit='iu'
+            ... )
+            >>> dphase = pulse.phase(derivative=True, s=1, method='savgol')
+            >>> bool(np.allclose(dphase, 2.0))
+            True
         """
+        if method not in ['spline', 'savgol']:
+            raise ValueError("Invalid method: %s" % method)
 
         phase = np.angle(self.amplitude)
         if unwrap or derivative:
             phase = np.unwrap(phase)
 
         tgrid = self.unit_convert.convert(self.tgrid, self.time_unit, 'iu')
+        if freq_unit is None:
+            freq_unit = self.freq_unit
+
+        if method == 'savgol':
+            from scipy.signal import savgol_filter
+
+            if s is None and derivative:
+                s = 11
+            if s is not None:
+                window = 2 * (int(math.ceil(s)) // 2) + 1
+                if derivative:
+                    # a window of polyorder + 2 points is the smallest one
+                    # for which the third-order fit yields a derivative
+                    window = max(window, 5)
+                window = min(window, len(tgrid))
+                if window % 2 == 0:
+                    window -= 1
+                polyorder = min(3, window - 1)
+                if derivative and polyorder < 1:
+                    raise ValueError(
+                        "Too few grid points for the derivative of the phase"
+                    )
+                phase = savgol_filter(
+                    phase,
+                    window,
+                    polyorder,
+                    deriv=(1 if derivative else 0),
+                    delta=(tgrid[1] - tgrid[0]),
+                )
+            if derivative:
+                return self.unit_convert.convert(phase, 'iu', freq_unit)
+            else:
+                return phase
+
+        from scipy.interpolate import UnivariateSpline
 
         if derivative:
 
-            if freq_unit is None:
-                freq_unit = self.freq_unit
             if s is None:
                 s = 1
             spl = UnivariateSpline(tgrid, phase, s=s)
             deriv = spl.derivative()(tgrid)
-            return self.unit_convert.convert(deriv, 'iu', self.freq_unit)
+            return self.unit_convert.convert(deriv, 'iu', freq_unit)
 
         else:  # direct phase
 
@@ -839,51 +1155,56 @@ class Pulse:
         postamble = self.postamble
         if not hasattr(postamble, '__getitem__'):
             postamble = [str(postamble)]
-        buffer = ''
+        header = []
         # preamble
         for line in preamble:
             line = str(line).strip()
             if line.startswith('#'):
-                buffer += "%s\n" % line
+                header.append("%s\n" % line)
             else:
-                buffer += '# %s\n' % line
+                header.append('# %s\n' % line)
         # header and data
         time_header = "time [%s]" % self.time_unit
         ampl_re_header = "Re(ampl) [%s]" % self.ampl_unit
         ampl_im_header = "Im(ampl) [%s]" % self.ampl_unit
         ampl_abs_header = "Abs(ampl) [%s]" % self.ampl_unit
         if mode == 'abs':
-            buffer += "# %23s%25s\n" % (time_header, ampl_abs_header)
-            for i, t in enumerate(self.tgrid):
-                buffer += "%25.17E%25.17E\n" % (t, abs(self.amplitude[i]))
+            header.append("# %23s%25s\n" % (time_header, ampl_abs_header))
+            # hypot rounds exactly like the scalar abs() of each value
+            ampl_abs = np.hypot(self.amplitude.real, self.amplitude.imag)
+            columns = (self.tgrid, ampl_abs)
         elif mode == 'real':
-            buffer += "# %23s%25s\n" % (time_header, ampl_re_header)
-            for i, t in enumerate(self.tgrid):
-                buffer += "%25.17E%25.17E\n" % (t, self.amplitude.real[i])
+            header.append("# %23s%25s\n" % (time_header, ampl_re_header))
+            columns = (self.tgrid, self.amplitude.real)
         elif mode == 'complex':
-            buffer += "# %23s%25s%25s\n" % (
-                time_header,
-                ampl_re_header,
-                ampl_im_header,
+            header.append(
+                "# %23s%25s%25s\n"
+                % (time_header, ampl_re_header, ampl_im_header)
             )
-            for i, t in enumerate(self.tgrid):
-                buffer += "%25.17E%25.17E%25.17E\n" % (
-                    t,
-                    self.amplitude.real[i],
-                    self.amplitude.imag[i],
-                )
+            columns = (self.tgrid, self.amplitude.real, self.amplitude.imag)
         else:
             raise ValueError("mode must be 'abs', 'real', or 'complex'")
-        # postamble
-        for line in self.postamble:
-            line = str(line).strip()
-            if line.startswith('#'):
-                buffer += "%s\n" % line
-            else:
-                buffer += '# %s' % line
 
-        with open_file(filename, 'w') as out_fh:
-            out_fh.write(buffer)
+        # the data is written in blocks of rows, so that only one block at a
+        # time has to be assembled in memory. Each block is formatted with a
+        # single %-operation, using a format string for all of its rows
+        block = 2 ** 16
+        row_fmt = '%25.17E' * len(columns) + '\n'
+        with open_file(filename, 'w', buffering=2 ** 20) as out_fh:
+            out_fh.write(''.join(header))
+            for i in range(0, len(self.tgrid), block):
+                data = np.column_stack([col[i : i + block] for col in columns])
+                values = tuple(data.ravel().tolist())
+                out_fh.write((row_fmt * len(data)) % values)
+            # postamble
+            footer = []
+            for line in self.postamble:
+                line = str(line).strip()
+                if line.startswith('#'):
+                    footer.append("%s\n" % line)
+                else:
+                    footer.append('# %s' % line)
+            out_fh.write(''.join(footer))
 
     def write_oct_spectral_filter(self, filename, filter_func, freq_unit=None):
         """Evaluate a spectral filter function and write the result to the file
@@ -905,13 +1226,16 @@ class Pulse:
             considers equivalent to floats in the range [0, 1]. This
             includes boolean values, where True is equivalent to 1.0 and
             False is equivalent to 0.0
+
+            The `filter_func` is first called with the entire array of
+            frequencies. Only if that fails or does not return an array of
+            the same size, it is called for each frequency value separately.
         """
         if freq_unit is None:
             freq_unit = self.freq_unit
         freqs = self.fftfreq(freq_unit=freq_unit)
-        filter = np.array([filter_func(f) for f in freqs], dtype=np.float64)
-        if not (0 <= np.min(filter) <= 1 and 0 <= np.max(filter) <= 1):
-            raise ValueError("filter values must be in the range [0, 1]")
+        filter = _evaluate_filter_func(filter_func, freqs)
+        _check_filter_range(filter)
         header = "%15s%15s" % ("freq [%s]" % freq_unit, 'filter')
         writetotxt(filename, freqs, filter, fmt='%15.7e%15.12f', header=header)
 
@@ -926,11 +1250,11 @@ class Pulse:
                 assumes.  If not given, defaults to the `freq_unit` attribute.
         """
         freqs, spec = self.spectrum(freq_unit=freq_unit)
-        filter = np.array([filter_func(f) for f in freqs], dtype=np.float64)
-        if not (0 <= np.min(filter) <= 1 and 0 <= np.max(filter) <= 1):
-            raise ValueError("filter values must be in the range [0, 1]")
+        filter = _evaluate_filter_func(filter_func, freqs)
+        _check_filter_range(filter)
         spec *= filter
-        self.amplitude = np.fft.ifft(spec)
+        # spec is a temporary array, so the inverse transform may reuse it
+        self.amplitude = ifft(spec, overwrite_x=True, workers=-1)
         return self
 
     def apply_smoothing(self, **kwargs):
@@ -939,6 +1263,8 @@ class Pulse:
         :py:class:`scipy.interpolate.UnivariateSpline`. This especially
         includes the smoothing parameter `s`.
         """
+        from scipy.interpolate import UnivariateSpline
+
         if iscomplexobj(self.amplitude):
             splx = UnivariateSpline(self.tgrid, self.amplitude.real, **kwargs)
             sply = UnivariateSpline(self.tgrid, self.amplitude.imag, **kwargs)
@@ -954,15 +1280,8 @@ class Pulse:
         tgrid_new = np.linspace(
             float(self.t0), float(self.T), len(self.tgrid) + 1
         )
-        pulse_new = np.zeros(
-            len(self.amplitude) + 1, dtype=self.amplitude.dtype.type
-        )
-        pulse_new[0] = self.amplitude[0]
-        for i in range(1, len(pulse_new) - 1):
-            pulse_new[i] = 0.5 * (self.amplitude[i - 1] + self.amplitude[i])
-        pulse_new[-1] = self.amplitude[-1]
         self.tgrid = tgrid_new
-        self.amplitude = pulse_new
+        self.amplitude = _unshift_kernel(self.amplitude)
         self._check()
 
     def _shift(self, data=None):
@@ -977,11 +1296,7 @@ class Pulse:
             data_old = self.amplitude
         else:
             data_old = data
-        data_new = np.zeros(len(data_old) - 1, dtype=data_old.dtype.type)
-        data_new[0] = data_old[0]
-        for i in range(1, len(data_new) - 1):
-            data_new[i] = 2.0 * data_old[i] - data_new[i - 1]
-        data_new[-1] = data_old[-1]
+        data_new = _shift_kernel(data_old)
         if data is None:
             self.tgrid = tgrid_new
             self.amplitude = data_new
@@ -1005,7 +1320,9 @@ class Pulse:
                 case the end point of the resampled pulse to change
             window (list, numpy.ndarray, callable, str, float, or tuple):
                 Specifies the window applied to the signal in the Fourier
-                domain.  See `sympy.signal.resample`.
+                domain.  See `sympy.signal.resample`. For `downsample`, the
+                window of the anti-aliasing FIR filter instead, see
+                `scipy.signal.resample_poly`
 
         Notes:
 
@@ -1015,6 +1332,10 @@ class Pulse:
             by the `T` and `t0` properties), up to some rounding errors.
             Downsampling, or using an arbitrary number will change the end
             point of the pulse in general.
+
+            Upsampling and `num` use FFT-based resampling. Downsampling uses
+            polyphase filtering, which keeps the original time step exactly
+            (multiplied by `downsample`) and avoids the FFT round trip.
         """
         self._unshift()
         nt = len(self.tgrid)
@@ -1023,20 +1344,36 @@ class Pulse:
             raise ValueError(
                 "Exactly one of upsample, downsample, or num must be given"
             )
+        if downsample is not None:
+            downsample = int(downsample)
+            assert downsample > 0, "downsample must be > 0"
+
+            from scipy.signal import resample_poly
+
+            kwargs = {}
+            if window is not None:
+                kwargs['window'] = window
+            a = resample_poly(self.amplitude, 1, downsample, **kwargs)
+            t = self.tgrid[0] + (downsample * float(self.dt)) * np.arange(
+                len(a)
+            )
+            self.amplitude = a
+            self.tgrid = t
+            self._shift()
+            return
+
         if num is None:
             if upsample is not None:
                 upsample = int(upsample)
                 num = nt * upsample
-            elif downsample is not None:
-                downsample = int(downsample)
-                assert downsample > 0, "downsample must be > 0"
-                num = nt / downsample
             else:
                 num = nt
         else:
             num = num + 1  # to account for shifting
 
-        a, t = signal.resample(self.amplitude, num, self.tgrid, window=window)
+        from scipy.signal import resample
+
+        a, t = resample(self.amplitude, num, self.tgrid, window=window)
 
         if upsample is not None:
             # discard last (upsample-1) elements
@@ -1050,7 +1387,7 @@ class Pulse:
 
     def render_pulse(self, ax, label='pulse'):
         """Render the pulse amplitude on the given axes."""
-        if np.max(np.abs(self.amplitude.imag)) > 0.0:
+        if self.is_complex and np.any(self.amplitude.imag):
             ax.plot(self.tgrid, np.abs(self.amplitude), label=label)
             ax.set_ylabel("abs(pulse) (%s)" % self.ampl_unit)
         else:
@@ -1102,18 +1439,16 @@ class Pulse:
         if zoom:
             # figure out the range of the spectrum
             max_amp = np.amax(spectrum)
+            significant_freqs = freq[spectrum > 0.001 * max_amp]
             if self.is_complex:
                 # we center the spectrum around zero, and extend
                 # symmetrically in both directions as far as there is
                 # significant amplitude
                 wmin = np.max(freq)
                 wmax = np.min(freq)
-                for i, w in enumerate(freq):
-                    if spectrum[i] > 0.001 * max_amp:
-                        if w > wmax:
-                            wmax = w
-                        if w < wmin:
-                            wmin = w
+                if len(significant_freqs) > 0:
+                    wmin = min(wmin, np.min(significant_freqs))
+                    wmax = max(wmax, np.max(significant_freqs))
                 wmax = max(abs(wmin), abs(wmax))
                 wmin = -wmax
             else:
@@ -1122,11 +1457,11 @@ class Pulse:
                 # only on the region that was significant amplitude
                 wmin = 0.0
                 wmax = 0.0
-                for i, w in enumerate(freq):
-                    if spectrum[i] > 0.001 * max_amp:
-                        if wmin == 0 and w > 0:
-                            wmin = w
-                        wmax = w
+                if len(significant_freqs) > 0:
+                    wmax = np.max(significant_freqs)
+                    positive_freqs = significant_freqs[significant_freqs > 0]
+                    if len(positive_freqs) > 0:
+                        wmin = np.min(positive_freqs)
             buffer = (wmax - wmin) * 0.1
 
         # plot spectrum
@@ -1205,6 +1540,9 @@ class Pulse:
         The remaining figargs are passed to `matplotlib.pyplot.figure` to
         create a new figure if `fig` is None.
         """
+        import matplotlib.pyplot as plt
+        from matplotlib.gridspec import GridSpec
+
         if fig is None:
             fig = plt.figure(**figargs)
 
@@ -1261,6 +1599,8 @@ class Pulse:
         """Show a plot of the pulse and its spectrum. All arguments will be
         passed to the plot method
         """
+        import matplotlib.pyplot as plt
+
         self.plot(**kwargs)  # uses plt.figure()
         plt.show()
 
@@ -1367,6 +1707,16 @@ def tgrid_from_config(tgrid_dict, time_unit, pulse_grid=True):
 ###############################################################################
 
 
+@memoize
+def _carrier_scale(time_unit, freq_unit):
+    """Factor `c` such that ``c * freq * t`` is the phase of a carrier with
+    frequency `freq` (in `freq_unit`) at time `t` (in `time_unit`)"""
+    unit_convert = UnitConvert()
+    return unit_convert.convert(1, time_unit, 'iu') * unit_convert.convert(
+        1, freq_unit, 'iu'
+    )
+
+
 def carrier(
     t, time_unit, freq, freq_unit, weights=None, phases=None, complex=False
 ):
@@ -1413,16 +1763,13 @@ def carrier(
         .. math::
             f = E / (\hbar * 2 * \pi)
     '''
-    unit_convert = UnitConvert()
     if np.isscalar(t):
         signal = 0.0
     else:
         signal = np.zeros(len(t), dtype=np.complex128)
         assert isinstance(t, np.ndarray), "t must be numpy array"
         assert t.dtype.type is np.float64, "t must be double precision real"
-    c = unit_convert.convert(1, time_unit, 'iu') * unit_convert.convert(
-        1, freq_unit, 'iu'
-    )
+    c = _carrier_scale(time_unit, freq_unit)
     if np.isscalar(freq):
         if complex:
             signal += np.exp(1j * c * freq * t)  # element-wise
@@ -1432,19 +1779,32 @@ def carrier(
         eps = 1.0e-16  # machine precision
         if weights is None:
             weights = np.ones(len(freq))
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
         if phases is None:
             phases = np.zeros(len(freq))
-        norm = float(sum(weights))
+        else:
+            phases = np.asarray(phases, dtype=np.float64)
+        norm = float(weights.sum())
         if norm > eps:
-            for (w, weight, phase) in zip(freq, weights, phases):
-                if weight > eps:
-                    weight = weight / norm
-                    if complex:
-                        signal += weight * np.exp(
-                            1j * (c * w * t + phase * np.pi)
-                        )
-                    else:
-                        signal += weight * np.cos(c * w * t + phase * np.pi)
+            mask = weights > eps
+            cw = c * np.asarray(freq, dtype=np.float64)[mask]
+            weights = weights[mask] / norm
+            # the phases broadcast along the time axes
+            phases = (phases[mask] * np.pi).reshape(
+                (-1,) + (1,) * np.ndim(t)
+            )
+            # all frequencies are evaluated at once, in chunks that limit
+            # the size of the (n_freq x n_t) intermediate arrays
+            chunk = max(1, _OUTER_CHUNK_SIZE // max(1, np.size(t)))
+            for i in range(0, len(cw), chunk):
+                arg = np.multiply.outer(cw[i : i + chunk], t)
+                arg += phases[i : i + chunk]
+                if complex:
+                    signal += weights[i : i + chunk] @ np.cos(arg)
+                    signal += 1j * (weights[i : i + chunk] @ np.sin(arg))
+                else:
+                    signal += weights[i : i + chunk] @ np.cos(arg)
     return signal
 
 
@@ -1482,10 +1842,7 @@ def CRAB_carrier(
         .. math::
             f = E / (\hbar * 2 * \pi)
     '''
-    unit_convert = UnitConvert()
-    c = unit_convert.convert(1, time_unit, 'iu') * unit_convert.convert(
-        1, freq_unit, 'iu'
-    )
+    c = _carrier_scale(time_unit, freq_unit)
     assert (
         len(a) == len(b) == len(freq)
     ), "freq, a, b must all be of the same length"
@@ -1493,11 +1850,22 @@ def CRAB_carrier(
         signal = np.zeros(len(t), dtype=np.complex128)
     else:
         signal = np.zeros(len(t), dtype=np.float64)
-    for w_n, a_n, b_n in zip(freq, a, b):
+    cw = c * np.asarray(freq, dtype=np.float64)
+    a = np.asarray(a)
+    b = np.asarray(b)
+    # all frequencies are evaluated at once, in chunks that limit the size of
+    # the (n_freq x n_t) intermediate arrays
+    chunk = max(1, _OUTER_CHUNK_SIZE // max(1, len(t)))
+    for i in range(0, len(cw), chunk):
+        arg = np.multiply.outer(cw[i : i + chunk], t)
+        cos_arg = np.cos(arg)
+        sin_arg = np.sin(arg)
+        a_n = a[i : i + chunk]
+        b_n = b[i : i + chunk]
+        signal += a_n @ cos_arg + b_n @ sin_arg
         if complex:
-            signal += (a_n - 1j * b_n) * np.exp(1j * c * w_n * t)
-        else:
-            signal += a_n * np.cos(c * w_n * t) + b_n * np.sin(c * w_n * t)
+            # (a_n - i b_n) * exp(i w_n t)
+            signal += 1j * (a_n @ sin_arg - b_n @ cos_arg)
     if normalize:
         nrm = np.abs(signal).max()
         if nrm > 1.0e-16:
@@ -1522,7 +1890,6 @@ def gaussian(t, t0, sigma):
     return np.exp(-(t - t0) ** 2 / (2 * sigma ** 2))
 
 
-@np.vectorize
 def box(t, t_start, t_stop):
     """Return a box-shape (Theta-function) that is zero before `t_start` and
     after `t_stop` and one elsewehere.
@@ -1540,11 +1907,7 @@ def box(t, t_start, t_stop):
             an array of size 1 (which for all intents and purposes can be used
             like a float)
     """
-    if t < t_start:
-        return 0.0
-    if t > t_stop:
-        return 0.0
-    return 1.0
+    return np.where((t < t_start) | (t > t_stop), 0.0, 1.0)
 
 
 def blackman(t, t_start, t_stop, a=0.16):
@@ -1587,7 +1950,6 @@ def blackman(t, t_start, t_stop, a=0.16):
     )
 
 
-@np.vectorize
 def flattop(t, t_start, t_stop, t_rise, t_fall=None):
     """Return flattop shape, starting at `t_start` with a sine-squared ramp
     that goes to 1 within `t_rise`, and ramps down to 0 again within `t_fall`
@@ -1609,14 +1971,17 @@ def flattop(t, t_start, t_stop, t_rise, t_fall=None):
             scalar, `flattop_ox_shape` is an array of size 1 (which for all
             intents and purposes can be used like a float)
     """
-    if t_start <= t <= t_stop:
-        f = 1.0
-        if t_fall is None:
-            t_fall = t_rise
-        if t <= t_start + t_rise:
-            f = np.sin(np.pi * (t - t_start) / (2.0 * t_rise)) ** 2
-        elif t >= t_stop - t_fall:
-            f = np.sin(np.pi * (t - t_stop) / (2.0 * t_fall)) ** 2
-        return f
-    else:
-        return 0.0
+    if t_fall is None:
+        t_fall = t_rise
+    t = np.asarray(t, dtype=np.float64)
+    f = np.zeros(t.shape)
+    in_window = (t_start <= t) & (t <= t_stop)
+    rising = in_window & (t <= t_start + t_rise)
+    falling = in_window & ~rising & (t >= t_stop - t_fall)
+    f[in_window] = 1.0
+    # the ramps are evaluated only where they are used (for zero t_rise or
+    # t_fall, they are undefined exactly at t_start or t_stop)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f[rising] = np.sin(0.5 * np.pi * (t[rising] - t_start) / t_rise) ** 2
+        f[falling] = np.sin(0.5 * np.pi * (t[falling] - t_stop) / t_fall) ** 2
+    return f
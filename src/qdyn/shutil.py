@@ -1,4 +1,6 @@
 import contextlib
+import functools
+import io
 import os
 from os import rmdir
 from shutil import *
@@ -13,15 +15,17 @@ def mkdir(name, mode=0o750):
     * Do nothing if the folder with the given `name` already exists
     * Raise OSError if there is already a file with the given `name`
     """
-    if os.path.isdir(name):
-        pass
-    elif os.path.isfile(name):
-        raise OSError(
-            "A file with the same name as the desired "
-            "dir, '%s', already exists." % name
-        )
-    else:
-        os.makedirs(name, mode)
+    try:
+        # with exist_ok, the kernel's mkdir call does the existence check; a
+        # stat is only needed in the rare case that `name` is not a directory
+        os.makedirs(name, mode, exist_ok=True)
+    except FileExistsError:
+        if os.path.isfile(name):
+            raise OSError(
+                "A file with the same name as the desired "
+                "dir, '%s', already exists." % name
+            )
+        raise
 
 
 def touch(fname):
@@ -29,16 +33,34 @@ def touch(fname):
     Touch a filename (similar to the unix 'touch' utility). If the file does
     not exist already, create it. Otherwise, update its access time.
     """
-    with open(fname, 'a'):
+    try:
         os.utime(fname, None)
+    except FileNotFoundError:
+        # a newly created file has the current time stamps already
+        os.close(os.open(fname, os.O_WRONLY | os.O_CREAT, 0o666))
 
 
-def find_files(directory, pattern):
+def find_files(
+    directory, pattern, *, skip_hidden=False, exclude_dirs=(), workers=None
+):
     """
     Iterate (recursively) over all the files matching the shell pattern
     ('*' will yield all files) in the given directory. There is no guarantee on
     the order in which files are processed
 
+    Subdirectories whose name is in `exclude_dirs` (e.g. ``('.git',
+    '__pycache__')``) are not searched at all. If `skip_hidden` is True, the
+    same applies to all subdirectories whose name starts with a dot. Hidden
+    files in the searched directories are still matched against `pattern`.
+    Symbolic links to directories are neither searched nor yielded; symbolic
+    links to files are matched like files.
+
+    If `workers` is given, the subdirectories of `directory` are searched in
+    parallel by a pool of `workers` threads, which helps mostly on network
+    file systems. In this case, the files in each subdirectory are only
+    yielded once the entire subdirectory has been searched, and stopping the
+    iteration early still waits for the running searches to finish.
+
     >>> files = ["find_files_test/a.txt", "find_files_test/a.dat",
     ...          "find_files_test/sub/b.txt", "find_files_test/sub/c.txt"]
     >>> mkdir("find_files_test/sub")
@@ -52,17 +74,234 @@ def find_files(directory, pattern):
     ...         assert file in found_files
     ...     else:
     ...         assert file not in found_files
+    >>> sorted(find_files("find_files_test", '*.txt', exclude_dirs=['sub']))
+    ['find_files_test/a.txt']
+
+    Like for :func:`os.walk`, directories that cannot be read are skipped:
+
+    >>> mkdir("find_files_test/locked")
+    >>> touch("find_files_test/locked/d.txt")
+    >>> os.chmod("find_files_test/locked", 0)
+    >>> walked = [
+    ...     os.path.join(root, file)
+    ...     for (root, _, files) in os.walk("find_files_test")
+    ...     for file in files if file.endswith('.txt')]
+    >>> sorted(find_files("find_files_test", '*.txt')) == sorted(walked)
+    True
+    >>> os.chmod("find_files_test/locked", 0o755)
     >>> rmtree("find_files_test")
     """
-    import fnmatch
+    for entry in find_entries(
+        directory,
+        pattern,
+        skip_hidden=skip_hidden,
+        exclude_dirs=exclude_dirs,
+        workers=workers,
+    ):
+        yield entry.path
+
+
+def find_files_batched(
+    directory,
+    pattern,
+    batch_size=512,
+    *,
+    skip_hidden=False,
+    exclude_dirs=(),
+    workers=None
+):
+    """
+    Like :func:`find_files`, but iterate over lists of up to `batch_size`
+    files. This is useful for handing the files to e.g. a thread pool in
+    chunks. There is no guarantee on the order in which files are processed
+
+    >>> mkdir("find_files_test")
+    >>> for i in range(5):
+    ...     touch("find_files_test/%d.txt" % i)
+    >>> [len(batch) for batch in find_files_batched("find_files_test", '*', 2)]
+    [2, 2, 1]
+    >>> rmtree("find_files_test")
+    """
+    batch = []
+    for entry in find_entries(
+        directory,
+        pattern,
+        skip_hidden=skip_hidden,
+        exclude_dirs=exclude_dirs,
+        workers=workers,
+    ):
+        batch.append(entry.path)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
 
+
+def find_files_with_stat(
+    directory, pattern, *, skip_hidden=False, exclude_dirs=(), workers=None
+):
+    """
+    Like :func:`find_files`, but iterate over tuples ``(path, stat_result)``.
+    The :class:`os.stat_result` is obtained from the directory entry (see
+    :func:`find_entries`), without following symbolic links. It is useful
+    e.g. for sorting the files by size or modification time::
+
+        >>> mkdir("find_files_test")
+        >>> with open("find_files_test/a.txt", "w") as out_fh:
+        ...     written_bytes = out_fh.write("Hello World")
+        >>> touch("find_files_test/b.txt")
+        >>> [
+        ...     (path, stat.st_size)
+        ...     for (path, stat) in sorted(
+        ...         find_files_with_stat("find_files_test", '*.txt'),
+        ...         key=lambda path_stat: path_stat[1].st_size,
+        ...     )
+        ... ]
+        [('find_files_test/b.txt', 0), ('find_files_test/a.txt', 11)]
+        >>> rmtree("find_files_test")
+    """
+    for entry in find_entries(
+        directory,
+        pattern,
+        skip_hidden=skip_hidden,
+        exclude_dirs=exclude_dirs,
+        workers=workers,
+    ):
+        yield entry.path, entry.stat(follow_symlinks=False)
+
+
+def find_entries(
+    directory, pattern, *, skip_hidden=False, exclude_dirs=(), workers=None
+):
+    """
+    Like :func:`find_files`, but iterate over the :class:`os.DirEntry`
+    objects of the matching files instead of their paths. Besides the
+    `path`, an entry has the file's `name`. The type of the file is known
+    from the directory listing, and the result of the entry's `stat()` method
+    is cached, so callers do not have to `stat` the path again
+
+    >>> mkdir("find_files_test")
+    >>> touch("find_files_test/a.txt")
+    >>> [entry.name for entry in find_entries("find_files_test", '*.txt')]
+    ['a.txt']
+    >>> rmtree("find_files_test")
+    """
     if not os.path.isdir(directory):
         raise IOError("directory %s does not exist" % directory)
-    for root, _, files in os.walk(directory):
-        for basename in files:
-            if fnmatch.fnmatch(basename, pattern):
-                filename = os.path.join(root, basename)
-                yield filename
+    match = _compile_pattern(pattern)
+    if workers is None:
+        yield from _scan_tree([directory], match, skip_hidden, exclude_dirs)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+
+        subdirs = []
+        yield from _scan_tree(
+            [directory], match, skip_hidden, exclude_dirs, subdirs=subdirs
+        )
+
+        def scan_subdir(subdir):
+            return list(_scan_tree([subdir], match, skip_hidden, exclude_dirs))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for found in executor.map(scan_subdir, subdirs):
+                yield from found
+
+
+def find_first(
+    directory, pattern, default=None, *, skip_hidden=False, exclude_dirs=()
+):
+    """
+    Return the path of the first file matching the shell `pattern` in the
+    given `directory` (recursively), or `default` if there is no such file.
+
+    The search stops at the first match, so this is cheaper than e.g.
+    ``list(find_files(directory, pattern))[0]``. If more than one file matches,
+    there is no guarantee which one is returned. See :func:`find_files` for
+    `skip_hidden` and `exclude_dirs`.
+
+    >>> mkdir("find_files_test/sub")
+    >>> touch("find_files_test/sub/a.txt")
+    >>> find_first("find_files_test", '*.txt')
+    'find_files_test/sub/a.txt'
+    >>> print(find_first("find_files_test", '*.dat'))
+    None
+    >>> rmtree("find_files_test")
+    """
+    if not os.path.isdir(directory):
+        raise IOError("directory %s does not exist" % directory)
+    entries = _scan_tree(
+        [directory], _compile_pattern(pattern), skip_hidden, exclude_dirs
+    )
+    with contextlib.closing(entries):
+        for entry in entries:
+            return entry.path
+    return default
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_pattern(pattern):
+    """Matcher for (normcased) file names, equivalent to `fnmatch.fnmatch`
+    with the given shell `pattern`. The matchers for the most recently used
+    patterns are cached"""
+    import fnmatch
+    import re
+
+    pattern = os.path.normcase(pattern)
+    # plain extensions ('*.dat') and literal names do not need a regex
+    if re.fullmatch(r'\*\.\w+', pattern, flags=re.ASCII):
+        suffix = pattern[1:]
+        return lambda name: name.endswith(suffix)
+    if not any(char in pattern for char in '*?['):
+        return pattern.__eq__
+    return re.compile(fnmatch.translate(pattern)).match
+
+
+def _scan_tree(roots, match, skip_hidden, exclude_dirs, subdirs=None):
+    """Iterate over the :class:`os.DirEntry` objects of the files in the
+    `roots` directories and all their subdirectories for whose (normcased)
+    name `match` returns a true value.
+
+    If a list `subdirs` is given, the subdirectories of `roots` are not
+    traversed, but their paths are appended to `subdirs`.
+    """
+    normcase = os.path.normcase
+    # depth-first traversal with os.scandir: the directory entries already
+    # know their type, so no additional stat call is needed for each entry
+    stack = list(roots)
+    if subdirs is None:
+        subdirs = stack
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue  # like os.walk, skip directories that cannot be listed
+        with entries:
+            while True:
+                try:
+                    entry = next(entries)
+                except StopIteration:
+                    break
+                except OSError:
+                    # like os.walk, skip the rest of a directory that cannot
+                    # be read (e.g. because it was removed in the meantime)
+                    break
+                # symlinks are never followed. Only the target of a symlink
+                # is stat'ed, to skip symlinked directories like os.walk does
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    is_link_to_dir = (
+                        not is_dir and entry.is_symlink() and entry.is_dir()
+                    )
+                except OSError:
+                    is_dir = is_link_to_dir = False
+                if is_dir:
+                    if skip_hidden and entry.name.startswith('.'):
+                        continue
+                    if entry.name not in exclude_dirs:
+                        subdirs.append(entry.path)
+                elif not is_link_to_dir and match(normcase(entry.name)):
+                    yield entry
 
 
 # 'chdir' context manager
@@ -77,17 +316,77 @@ def chdir(dirname=None):
         ...     pass
         >>> rmdir('dir')
     """
-    curdir = os.getcwd()
+    # where possible, remember the current directory through a descriptor:
+    # this is cheaper than getcwd, and robust against the directory being
+    # renamed in the meantime
+    curdir = None
+    if os.chdir in os.supports_fd:
+        try:
+            curdir = os.open(os.curdir, os.O_RDONLY)
+        except OSError:  # e.g. no read permission for the current directory
+            pass
+    if curdir is None:
+        curdir = os.getcwd()
     try:
         if dirname is not None:
             os.chdir(dirname)
         yield
     finally:
-        os.chdir(curdir)
+        try:
+            os.chdir(curdir)
+        finally:
+            if isinstance(curdir, int):
+                os.close(curdir)
+
+
+@contextlib.contextmanager
+def at_dir(dirname):
+    """Open a file descriptor for the directory `dirname`.
+
+    Unlike :func:`chdir`, this does not change the (process-wide) working
+    directory, so it can be used safely from several threads. Paths relative
+    to `dirname` are accessed by passing the descriptor as the `dir_fd`
+    argument of functions in :mod:`os` (on platforms in
+    :data:`os.supports_dir_fd`). Use as::
+
+        >>> mkdir('dir')
+        >>> with at_dir('dir') as fd:
+        ...     os.close(os.open('file', os.O_CREAT | os.O_WRONLY, dir_fd=fd))
+        ...     os.path.isfile('dir/file')
+        True
+        >>> rmtree('dir')
+    """
+    fd = os.open(dirname, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
 
+def tail(file, n, block_size=8192):
+    """Print the last n lines of the given file
 
-def tail(file, n):
-    """Print the last n lines of the given file"""
-    with open(file) as in_fh:
+    The file is read backwards in blocks of `block_size` bytes, only until
+    it is known to contain the last n lines.
+    """
+    if n <= 0:  # lines[-n:] refers to (almost) the entire file
+        with open(file) as in_fh:
+            lines = in_fh.readlines()
+            print("".join(lines[-n:]))
+        return
+    with open(file, 'rb') as in_fh:
+        pos = in_fh.seek(0, os.SEEK_END)
+        data = b''
+        while pos > 0 and data.count(b'\n') <= n:
+            read_size = min(block_size, pos)
+            pos -= read_size
+            in_fh.seek(pos)
+            data = in_fh.read(read_size) + data
+    if pos > 0:
+        # drop the (possibly incomplete) line before the last n lines
+        data = data[data.index(b'\n') + 1 :]
+    # decode with the same defaults (encoding and universal newlines) as a
+    # file opened in text mode
+    with io.TextIOWrapper(io.BytesIO(data)) as in_fh:
         lines = in_fh.readlines()
-        print("".join(lines[-n:]))
+    print("".join(lines[-n:]))